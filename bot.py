@@ -2,16 +2,25 @@
 import discord
 from discord.ext import commands, tasks
 import asyncio
-import json
+import orjson
 import os
+import sqlite3
 import datetime
+import heapq
 import random
+import re
 import string
-import uuid
-from typing import Dict, Any, Optional, List
+import sys
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Any, Optional, List, Tuple
 
 # ---------- Configuration ----------
+DB_FILE = "lotteries.db"
+# Older versions persisted to these; they are imported into DB_FILE on first start
 DATA_FILE = "lotteries_data.json"
+WAL_FILE = "lotteries.wal"
 BOT_PREFIX = "!"
 INTENTS = discord.Intents.default()
 INTENTS.message_content = True
@@ -27,36 +36,235 @@ save_lock = asyncio.Lock()
 
 bot = commands.Bot(command_prefix=BOT_PREFIX, intents=INTENTS)
 
-# In-memory structures (persisted to DATA_FILE)
+# In-memory structures (persisted to DB_FILE: one row per lottery in `lotteries`,
+# one row per ticket in `tickets`, written as each mutation happens)
 # lotteries: dict[msg_id_str] = lottery_obj
 # Each lottery_obj contains:
 #  - id (message id when posted to display) (string)
-#  - item, seller_id, ticket_price, max_tickets (or None), end_time (iso str)
+#  - item, seller_id (int), ticket_price, max_tickets (or None)
+#  - ticket_channel_id (int)
+#  - end_ts (unix seconds, int); end_time (iso str) is kept for older readers
 #  - image_url (optional)
-#  - tickets: list of {code: str, buyer_id: str}
+#  - display_channel_id (int)
+#  - codes, buyers: parallel lists, ticket i is codes[i] bought by buyers[i] (strings)
 #  - created_at
+#  - _cached_embed_dict: static part of the display embed (see _build_lottery_embed)
 lotteries: Dict[str, Dict[str, Any]] = {}
 
+# buyer_index: dict[buyer_id_str] = [(msg_id_str, code), ...] across active lotteries.
+# Derived from `lotteries`; rebuilt in load_data and pruned in finalize_lottery.
+buyer_index: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
+
+# Resolved channels/categories keyed by (guild_id, lowercased name), so hot
+# paths like !buy don't re-scan guild.text_channels on every call.
+# Entries are dropped by the on_guild_channel_delete/update listeners.
+_channel_cache: Dict[Tuple[int, str], discord.TextChannel] = {}
+_category_cache: Dict[Tuple[int, str], discord.CategoryChannel] = {}
+
+# active_by_channel: dict[display_channel_id] = deque of active msg_id_strs posted
+# there, oldest first, so !buy just peeks [-1] instead of scanning channel history.
+active_by_channel: Dict[int, Deque[str]] = defaultdict(deque)
+
+# Display updates are coalesced: !buy marks a lottery dirty (msg_id_str -> guild_id)
+# and flush_display_updates edits each dirty message at most once per tick.
+# _display_messages keeps the posted discord.Message so edits skip fetch_message.
+_dirty: Dict[str, int] = {}
+_display_messages: Dict[str, discord.Message] = {}
+
+# lottery_locks: dict[msg_id_str] = lock held by !buy around the check-and-sell
+lottery_locks: Dict[str, asyncio.Lock] = {}
+
+# pending: heap of (deadline on the loop clock, msg_id_str, guild_id) drained by
+# a single _timer_loop task instead of one sleeping task per lottery.
+pending: List[Tuple[float, str, int]] = []
+# created in on_ready: on Python < 3.10 an Event made at import binds to the wrong loop
+_timer_wakeup: Optional[asyncio.Event] = None
+_timer_task: Optional[asyncio.Task] = None
+
+# on_ready fires again after reconnects; state is only restored the first time
+_restored = False
+
+_db: Optional[sqlite3.Connection] = None
+_LOTTERY_COLUMNS = (
+    "id", "item", "seller_id", "ticket_price", "max_tickets", "image_url",
+    "display_channel_id", "ticket_channel_id", "created_at", "end_time", "end_ts",
+)
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lotteries (
+    id TEXT PRIMARY KEY,
+    item TEXT NOT NULL,
+    seller_id INTEGER NOT NULL,
+    ticket_price TEXT,
+    max_tickets INTEGER,
+    image_url TEXT,
+    display_channel_id INTEGER,
+    ticket_channel_id INTEGER,
+    created_at TEXT,
+    end_time TEXT,
+    end_ts INTEGER NOT NULL,
+    embed BLOB
+);
+CREATE TABLE IF NOT EXISTS tickets (
+    lottery_id TEXT NOT NULL,
+    code TEXT NOT NULL,
+    buyer_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tickets_lottery_id ON tickets (lottery_id);
+"""
+
 def now_iso():
     return datetime.datetime.utcnow().isoformat()
 
-def load_data():
-    global lotteries
+def migrate_lottery(lot: Dict[str, Any]):
+    """Bring a lottery saved by an older version up to the current layout."""
+    # tickets used to be a list of {code, buyer_id} dicts
+    if "tickets" in lot:
+        tickets = lot.pop("tickets")
+        lot["codes"] = [t["code"] for t in tickets]
+        lot["buyers"] = [t["buyer_id"] for t in tickets]
+    # ids used to be stored as strings
+    lot["seller_id"] = int(lot["seller_id"])
+    if lot.get("ticket_channel_id"):
+        lot["ticket_channel_id"] = int(lot["ticket_channel_id"])
+    if lot.get("display_channel_id"):
+        lot["display_channel_id"] = int(lot["display_channel_id"])
+    # end_time was a naive UTC iso string before end_ts existed
+    lot.pop("_cached_end_ts", None)
+    if "end_ts" not in lot:
+        end_dt = datetime.datetime.fromisoformat(lot["end_time"]).replace(tzinfo=datetime.timezone.utc)
+        lot["end_ts"] = int(end_dt.timestamp())
+
+def _apply_legacy_record(lots: Dict[str, Dict[str, Any]], record: Dict[str, Any]):
+    op = record.get("op")
+    if op == "create":
+        migrate_lottery(record["lottery"])
+        lots[record["lid"]] = record["lottery"]
+    elif op == "buy":
+        lottery = lots.get(record["lid"])
+        # a snapshot taken between the in-memory buy and its log line already has these tickets
+        if lottery is not None and record["codes"][0] not in lottery["codes"]:
+            lottery["codes"].extend(record["codes"])
+            lottery["buyers"].extend([record["buyer"]] * len(record["codes"]))
+    elif op == "finalize":
+        lots.pop(record["lid"], None)
+
+@contextmanager
+def _transaction(db: sqlite3.Connection):
+    db.execute("BEGIN")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+def open_db() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        # autocommit; callers on the event loop go through db_write/save_lock,
+        # so the connection is never used from two threads at once
+        _db = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.executescript(_SCHEMA)
+    return _db
+
+def _lottery_row(lot: Dict[str, Any]) -> tuple:
+    embed = lot.get("_cached_embed_dict")
+    return tuple(lot.get(c) for c in _LOTTERY_COLUMNS) + (orjson.dumps(embed) if embed else None,)
+
+_INSERT_LOTTERY = f"INSERT OR REPLACE INTO lotteries ({', '.join(_LOTTERY_COLUMNS)}, embed) VALUES ({', '.join('?' * (len(_LOTTERY_COLUMNS) + 1))})"
+_INSERT_TICKET = "INSERT INTO tickets (lottery_id, code, buyer_id) VALUES (?, ?, ?)"
+
+def _db_insert_lottery(row: tuple):
+    open_db().execute(_INSERT_LOTTERY, row)
+
+def _db_insert_tickets(rows: List[Tuple[str, str, str]]):
+    with _transaction(open_db()) as db:
+        db.executemany(_INSERT_TICKET, rows)
+
+def _db_delete_lottery(lottery_id: str):
+    with _transaction(open_db()) as db:
+        db.execute("DELETE FROM tickets WHERE lottery_id = ?", (lottery_id,))
+        db.execute("DELETE FROM lotteries WHERE id = ?", (lottery_id,))
+
+async def db_write(fn, *args):
+    """Run a blocking DB write in a worker thread, one at a time."""
+    async with save_lock:
+        await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+def _import_legacy_json(db: sqlite3.Connection):
+    """One-time import of lotteries saved by the JSON snapshot + log versions."""
+    lots: Dict[str, Dict[str, Any]] = {}
     if os.path.exists(DATA_FILE):
         try:
-            with open(DATA_FILE, "r") as f:
-                data = json.load(f)
-            lotteries = data.get("lotteries", {})
+            with open(DATA_FILE, "rb") as f:
+                lots = orjson.loads(f.read()).get("lotteries", {})
+            for lot in lots.values():
+                migrate_lottery(lot)
         except Exception:
-            lotteries = {}
-    else:
-        lotteries = {}
-
-async def save_data():
+            lots = {}
+    if os.path.exists(WAL_FILE):
+        with open(WAL_FILE, "rb") as f:
+            for line in f:
+                try:
+                    _apply_legacy_record(lots, orjson.loads(line))
+                except Exception:
+                    # a torn last line from a crash mid-write; skip it
+                    continue
+    with _transaction(db):
+        for lid, lot in lots.items():
+            lot["id"] = lid
+            db.execute(_INSERT_LOTTERY, _lottery_row(lot))
+            db.executemany(_INSERT_TICKET, [(lid, c, b) for c, b in zip(lot["codes"], lot["buyers"])])
+    for path in (DATA_FILE, WAL_FILE):
+        if os.path.exists(path):
+            os.replace(path, path + ".migrated")
+
+def rebuild_buyer_index():
+    buyer_index.clear()
+    for lid, lot in lotteries.items():
+        for code, buyer_id in zip(lot["codes"], lot["buyers"]):
+            buyer_index[buyer_id].append((lid, code))
+
+def _read_db() -> Dict[str, Dict[str, Any]]:
+    db = open_db()
+    if db.execute("SELECT 1 FROM lotteries LIMIT 1").fetchone() is None:
+        _import_legacy_json(db)
+    lots: Dict[str, Dict[str, Any]] = {}
+    for row in db.execute(f"SELECT {', '.join(_LOTTERY_COLUMNS)}, embed FROM lotteries"):
+        lot = dict(zip(_LOTTERY_COLUMNS, row))
+        if row[-1] is not None:
+            lot["_cached_embed_dict"] = orjson.loads(row[-1])
+        lot["codes"] = []
+        lot["buyers"] = []
+        lots[lot["id"]] = lot
+    for lottery_id, code, buyer_id in db.execute("SELECT lottery_id, code, buyer_id FROM tickets ORDER BY rowid"):
+        lot = lots.get(lottery_id)
+        if lot is not None:
+            lot["codes"].append(code)
+            # sqlite hands back a fresh str per row; share one object per buyer
+            lot["buyers"].append(sys.intern(buyer_id))
+    return lots
+
+async def load_data():
+    """Read all lotteries from the DB in a worker thread, then swap in the in-memory maps."""
+    global lotteries
     async with save_lock:
-        data = {"lotteries": lotteries}
-        with open(DATA_FILE, "w") as f:
-            json.dump(data, f, indent=2, default=str)
+        lots = await asyncio.get_running_loop().run_in_executor(None, _read_db)
+    lotteries = lots
+    rebuild_buyer_index()
+
+def rebuild_active_by_channel():
+    """Rebuild the per-channel queues of active lotteries from `lotteries`, oldest first."""
+    active_by_channel.clear()
+    ordered = sorted(lotteries.items(), key=lambda item: item[1].get("created_at", ""))
+    for msg_id_str, lot in ordered:
+        if lot.get("display_channel_id"):
+            active_by_channel[lot["display_channel_id"]].append(msg_id_str)
+
+# shell-style words: runs of bare characters and "..." / '...' sections, no escapes
+_ARG_RE = re.compile(r"""(?:"[^"]*"|'[^']*'|[^\s"'])+""")
+_QUOTED_RE = re.compile(r""""([^"]*)"|'([^']*)'""")
 
 def parse_duration(s: str) -> int:
     """
@@ -75,25 +283,46 @@ def parse_duration(s: str) -> int:
         return int(s[:-1]) * 3600
     return int(s)
 
-def gen_ticket_code() -> str:
-    """Generate a short unique ticket code."""
-    # Use uuid4 + short slice to be reasonably unique
-    return uuid.uuid4().hex[:8].upper()
+def gen_ticket_codes(count: int) -> List[str]:
+    """Generate `count` short unique ticket codes."""
+    # One urandom read for the whole batch, 4 random bytes (8 hex chars) per code
+    raw = os.urandom(4 * count)
+    return [raw[i * 4:(i + 1) * 4].hex().upper() for i in range(count)]
 
 async def find_or_create_category(guild: discord.Guild, name: str) -> discord.CategoryChannel:
+    key = (guild.id, name.lower())
+    cached = _category_cache.get(key)
+    if cached is not None:
+        return cached
     for c in guild.categories:
-        if c.name.lower() == name.lower():
+        if c.name.lower() == key[1]:
+            _category_cache[key] = c
             return c
-    return await guild.create_category(name)
+    c = await guild.create_category(name)
+    _category_cache[key] = c
+    return c
 
 async def find_or_create_channel(guild: discord.Guild, name: str, category_name: Optional[str]=None) -> discord.TextChannel:
+    key = (guild.id, name.lower())
+    cached = _channel_cache.get(key)
+    if cached is not None:
+        return cached
     for ch in guild.text_channels:
-        if ch.name.lower() == name.lower():
+        if ch.name.lower() == key[1]:
+            _channel_cache[key] = ch
             return ch
     cat = None
     if category_name:
         cat = await find_or_create_category(guild, category_name)
-    return await guild.create_text_channel(name, category=cat)
+    ch = await guild.create_text_channel(name, category=cat)
+    _channel_cache[key] = ch
+    return ch
+
+def _forget_channel(channel: discord.abc.GuildChannel):
+    """Drop any cached channel/category entries pointing at this channel."""
+    for cache in (_channel_cache, _category_cache):
+        for key in [k for k, v in cache.items() if v.id == channel.id]:
+            del cache[key]
 
 async def create_ticket_channel(guild: discord.Guild, seller: discord.Member, item_name: str) -> discord.TextChannel:
     cat = await find_or_create_category(guild, TICKET_CATEGORY_NAME)
@@ -112,59 +341,68 @@ async def create_ticket_channel(guild: discord.Guild, seller: discord.Member, it
     await channel.send(f"🎟️ Ticket channel for {seller.mention}\nItem: **{item_name}**\nWhen the lottery ends the result will be posted here.")
     return channel
 
-async def post_lottery_display(guild: discord.Guild, lottery: Dict[str, Any]) -> int:
+def _build_lottery_embed(lottery: Dict[str, Any], tickets_field: bool=True) -> discord.Embed:
+    """
+    Build the display embed for a lottery. The static part is built once and
+    cached on the lottery; only the tickets sold count changes between calls.
+    Shown as a field on the first post and as the footer on later edits.
+    """
+    cached = lottery.get("_cached_embed_dict")
+    if cached is None:
+        embed = discord.Embed(
+            title=f"Lottery: {lottery['item']}",
+            description=(
+                f"Seller: <@{lottery['seller_id']}>\n"
+                f"Ticket Price: {lottery['ticket_price']}\n"
+                f"Max Tickets: {lottery['max_tickets'] if lottery.get('max_tickets') else 'Unlimited'}\n"
+                f"Ends: <t:{lottery['end_ts']}:R>\n\n"
+                "Buy tickets with `!buy <count>` in this channel."
+            ),
+            timestamp=datetime.datetime.utcnow()
+        )
+        if lottery.get("image_url"):
+            embed.set_image(url=lottery["image_url"])
+        cached = lottery["_cached_embed_dict"] = embed.to_dict()
+    d = cached.copy()
+    sold = str(len(lottery["codes"]))
+    if tickets_field:
+        d["fields"] = [{"name": "Tickets Sold", "value": sold, "inline": True}]
+    else:
+        d["footer"] = {"text": f"Tickets Sold: {sold}"}
+    return discord.Embed.from_dict(d)
+
+async def post_lottery_display(guild: discord.Guild, lottery: Dict[str, Any]) -> Tuple[int, int]:
     """
     Post the lottery to the display channel.
-    Returns the message id posted (int).
+    Returns (message id posted, display channel id).
     """
     display = await find_or_create_channel(guild, LOTTERY_DISPLAY_CHANNEL, LOTTERY_CATEGORY_NAME)
-    embed = discord.Embed(
-        title=f"Lottery: {lottery['item']}",
-        description=(
-            f"Seller: <@{lottery['seller_id']}>\n"
-            f"Ticket Price: {lottery['ticket_price']}\n"
-            f"Max Tickets: {lottery['max_tickets'] if lottery.get('max_tickets') else 'Unlimited'}\n"
-            f"Ends: <t:{int(datetime.datetime.fromisoformat(lottery['end_time']).timestamp())}:R>\n\n"
-            "Buy tickets with `!buy <count>` in this channel."
-        ),
-        timestamp=datetime.datetime.utcnow()
-    )
-    if lottery.get("image_url"):
-        embed.set_image(url=lottery["image_url"])
-    embed.add_field(name="Tickets Sold", value=str(len(lottery.get("tickets", []))))
-    msg = await display.send(embed=embed)
-    return msg.id
+    msg = await display.send(embed=_build_lottery_embed(lottery))
+    lottery["display_channel_id"] = display.id
+    active_by_channel[display.id].append(str(msg.id))
+    _display_messages[str(msg.id)] = msg
+    return msg.id, display.id
 
 async def update_display_message(guild: discord.Guild, message_id: int):
     """
     Edit the display message embed to reflect updated tickets sold.
+    A deleted message is ignored; other HTTP errors are left to the caller.
     """
-    display_chan = await find_or_create_channel(guild, LOTTERY_DISPLAY_CHANNEL, LOTTERY_CATEGORY_NAME)
-    try:
-        msg = await display_chan.fetch_message(message_id)
-    except discord.NotFound:
-        return
     lottery = lotteries.get(str(message_id))
     if not lottery:
         return
-    embed = discord.Embed(
-        title=f"Lottery: {lottery['item']}",
-        description=(
-            f"Seller: <@{lottery['seller_id']}>\n"
-            f"Ticket Price: {lottery['ticket_price']}\n"
-            f"Max Tickets: {lottery['max_tickets'] if lottery.get('max_tickets') else 'Unlimited'}\n"
-            f"Ends: <t:{int(datetime.datetime.fromisoformat(lottery['end_time']).timestamp())}:R>\n\n"
-            "Buy tickets with `!buy <count>` in this channel."
-        ),
-        timestamp=datetime.datetime.utcnow()
-    )
-    if lottery.get("image_url"):
-        embed.set_image(url=lottery["image_url"])
-    embed.set_footer(text=f"Tickets Sold: {len(lottery.get('tickets', []))}")
+    msg = _display_messages.get(str(message_id))
+    if msg is None:
+        display_chan = await find_or_create_channel(guild, LOTTERY_DISPLAY_CHANNEL, LOTTERY_CATEGORY_NAME)
+        try:
+            msg = await display_chan.fetch_message(message_id)
+        except discord.NotFound:
+            return
+        _display_messages[str(message_id)] = msg
     try:
-        await msg.edit(embed=embed)
-    except Exception:
-        pass
+        await msg.edit(embed=_build_lottery_embed(lottery, tickets_field=False))
+    except discord.NotFound:
+        _display_messages.pop(str(message_id), None)
 
 async def finalize_lottery(guild: discord.Guild, message_id_str: str):
     """
@@ -173,21 +411,39 @@ async def finalize_lottery(guild: discord.Guild, message_id_str: str):
     lottery = lotteries.pop(message_id_str, None)
     if not lottery:
         return
+    _dirty.pop(message_id_str, None)
+    lottery_locks.pop(message_id_str, None)
+    _display_messages.pop(message_id_str, None)
+    for buyer_id in set(lottery["buyers"]):
+        remaining = [e for e in buyer_index.get(buyer_id, []) if e[0] != message_id_str]
+        if remaining:
+            buyer_index[buyer_id] = remaining
+        else:
+            buyer_index.pop(buyer_id, None)
+    if lottery.get("display_channel_id"):
+        active = active_by_channel.get(lottery["display_channel_id"])
+        if active and message_id_str in active:
+            active.remove(message_id_str)
+    # drop the row before any network I/O so a failed announcement can't leave
+    # the lottery in the DB to be drawn again on the next start
+    await db_write(_db_delete_lottery, message_id_str)
     # pick winner
-    tickets = lottery.get("tickets", [])
-    seller = guild.get_member(int(lottery["seller_id"]))
-    ticket_channel = guild.get_channel(int(lottery["ticket_channel_id"])) if lottery.get("ticket_channel_id") else None
-
-    if tickets:
-        winning_ticket = random.choice(tickets)
-        winner_id = int(winning_ticket["buyer_id"])
-        winner = guild.get_member(winner_id)
+    codes = lottery["codes"]
+    seller = guild.get_member(lottery["seller_id"])
+    ticket_channel = guild.get_channel(lottery["ticket_channel_id"]) if lottery.get("ticket_channel_id") else None
+
+    if codes:
+        # pick by index so the draw doesn't depend on the ticket record layout
+        idx = random.randrange(len(codes))
+        winning_code = codes[idx]
+        winner_id = int(lottery["buyers"][idx])
+        winner = bot.get_user(winner_id) or guild.get_member(winner_id)
         # Announce in display channel
         display_chan = await find_or_create_channel(guild, LOTTERY_DISPLAY_CHANNEL, LOTTERY_CATEGORY_NAME)
         announce_text = (
             f"🎉 **Lottery Ended: {lottery['item']}**\n"
             f"Winner: <@{winner_id}> \n"
-            f"Winning Ticket: `{winning_ticket['code']}`\n"
+            f"Winning Ticket: `{winning_code}`\n"
             f"Seller: <@{lottery['seller_id']}>"
         )
         await display_chan.send(announce_text)
@@ -197,12 +453,12 @@ async def finalize_lottery(guild: discord.Guild, message_id_str: str):
         # DM buyer and seller friendly summary
         try:
             if winner:
-                await winner.send(f"Congrats! You won the lottery for **{lottery['item']}** with ticket `{winning_ticket['code']}`. Please contact the seller <@{lottery['seller_id']}>.")
+                await winner.send(f"Congrats! You won the lottery for **{lottery['item']}** with ticket `{winning_code}`. Please contact the seller <@{lottery['seller_id']}>.")
         except Exception:
             pass
         try:
             if seller:
-                await seller.send(f"Your lottery for **{lottery['item']}** has ended. Winner: <@{winner_id}> with ticket `{winning_ticket['code']}`.")
+                await seller.send(f"Your lottery for **{lottery['item']}** has ended. Winner: <@{winner_id}> with ticket `{winning_code}`.")
         except Exception:
             pass
     else:
@@ -217,32 +473,88 @@ async def finalize_lottery(guild: discord.Guild, message_id_str: str):
         except Exception:
             pass
 
-    await save_data()
-
-async def lottery_timer_task(guild: discord.Guild, message_id_str: str, seconds: int):
-    try:
-        await asyncio.sleep(seconds)
-        # finalize
-        await finalize_lottery(guild, message_id_str)
-    except asyncio.CancelledError:
-        pass
+def schedule_lottery(guild: discord.Guild, message_id_str: str, seconds: float):
+    """Queue a lottery to be finalized after `seconds` and wake the timer loop."""
+    deadline = asyncio.get_running_loop().time() + seconds
+    heapq.heappush(pending, (deadline, message_id_str, guild.id))
+    _wake_timer()
+
+def _wake_timer():
+    # before the loop starts there is nothing to wake; it checks the heap first
+    if _timer_wakeup is not None:
+        _timer_wakeup.set()
+
+async def _timer_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        _timer_wakeup.clear()
+        timeout = None
+        if pending:
+            timeout = pending[0][0] - loop.time()
+            if timeout <= 0:
+                _, message_id_str, guild_id = heapq.heappop(pending)
+                guild = bot.get_guild(guild_id)
+                # lotteries ended early via !endlottery are already gone
+                if guild and message_id_str in lotteries:
+                    bot.loop.create_task(finalize_lottery(guild, message_id_str))
+                continue
+        try:
+            await asyncio.wait_for(_timer_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
 # Load existing data on startup and resume timers
 @bot.event
 async def on_ready():
+    global _timer_task, _timer_wakeup, _restored
     print(f"✅ Logged in as {bot.user} (ID: {bot.user.id})")
-    load_data()
-    # Attempt to re-create timers for active lotteries
-    for msg_id_str, lot in list(lotteries.items()):
-        end_time = datetime.datetime.fromisoformat(lot["end_time"])
-        seconds_left = (end_time - datetime.datetime.utcnow()).total_seconds()
-        if seconds_left <= 0:
-            # finalize immediately
-            bot.loop.create_task(finalize_lottery(bot.guilds[0], msg_id_str))
-        else:
-            bot.loop.create_task(lottery_timer_task(bot.guilds[0], msg_id_str, int(seconds_left)))
-    # start periodic save
-    periodic_save.start()
+    # the timer and flush loops don't depend on restored state, so start them first
+    if _timer_task is None:
+        _timer_wakeup = asyncio.Event()
+        _timer_task = bot.loop.create_task(_timer_loop())
+    if not flush_display_updates.is_running():
+        flush_display_updates.start()
+    if _restored:
+        return
+    # set before the first await so a reconnect meanwhile doesn't restore twice;
+    # cleared again if the restore fails so the next on_ready retries
+    _restored = True
+    try:
+        await load_data()
+        if lotteries and not bot.guilds:
+            # nowhere to resume these yet; try again on the next on_ready
+            _restored = False
+            return
+        # Older data files don't record the display channel; assume the default one
+        if any(not lot.get("display_channel_id") for lot in lotteries.values()):
+            display = await find_or_create_channel(bot.guilds[0], LOTTERY_DISPLAY_CHANNEL, LOTTERY_CATEGORY_NAME)
+            for lot in lotteries.values():
+                if not lot.get("display_channel_id"):
+                    lot["display_channel_id"] = display.id
+                    await db_write(_db_insert_lottery, _lottery_row(lot))
+        rebuild_active_by_channel()
+        # Re-create timers for active lotteries in one heap rebuild; already expired
+        # ones get a deadline in the past so the timer loop finalizes them first
+        if lotteries:
+            loop_now = asyncio.get_running_loop().time()
+            wall_now = time.time()
+            guild_id = bot.guilds[0].id
+            pending.extend((loop_now + lot["end_ts"] - wall_now, msg_id_str, guild_id) for msg_id_str, lot in lotteries.items())
+            heapq.heapify(pending)
+            _wake_timer()
+    except BaseException:
+        _restored = False
+        raise
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    _forget_channel(channel)
+
+@bot.event
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    # a rename means the cached name key no longer matches
+    if before.name != after.name:
+        _forget_channel(before)
 
 # ----------------- Commands -----------------
 
@@ -267,11 +579,10 @@ async def lottery_create(ctx: commands.Context, action: str, *, rest: str = None
 
     # split by spaces but keep quoted item name
     # Expecting: "Item Name" duration ticket_price [max_tickets]
-    import shlex
-    try:
-        parts = shlex.split(rest)
-    except Exception:
+    # anything the tokenizer can't consume is an unclosed quote
+    if _ARG_RE.sub("", rest).strip():
         return await ctx.send("Couldn't parse command. Make sure the item name is in quotes if it has spaces.")
+    parts = [_QUOTED_RE.sub(r"\1\2", m.group(0)) for m in _ARG_RE.finditer(rest)]
 
     if len(parts) < 3:
         return await ctx.send("Missing parameters. Usage: `!lottery create \"Item Name\" <duration> <ticket_price> [max_tickets]`")
@@ -297,6 +608,7 @@ async def lottery_create(ctx: commands.Context, action: str, *, rest: str = None
     except Exception:
         return await ctx.send("Couldn't parse duration. Examples: 10m, 30s, 1h")
 
+    end_ts = int(time.time()) + seconds
     end_time = (datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)).isoformat()
     # create ticket channel for seller
     ticket_chan = await create_ticket_channel(ctx.guild, ctx.author, item_name)
@@ -304,24 +616,26 @@ async def lottery_create(ctx: commands.Context, action: str, *, rest: str = None
     # build lottery object
     lottery_obj = {
         "item": item_name,
-        "seller_id": str(ctx.author.id),
+        "seller_id": ctx.author.id,
         "ticket_price": ticket_price,
         "max_tickets": max_tickets,
         "image_url": image_url,
-        "tickets": [],  # list of {code, buyer_id}
+        "codes": [],  # ticket codes
+        "buyers": [],  # buyer id per code
         "created_at": now_iso(),
         "end_time": end_time,
-        "ticket_channel_id": str(ticket_chan.id)
+        "end_ts": end_ts,
+        "ticket_channel_id": ticket_chan.id
     }
 
     # post to display channel
-    msg_id = await post_lottery_display(ctx.guild, lottery_obj)
+    msg_id, display_channel_id = await post_lottery_display(ctx.guild, lottery_obj)
     lottery_obj["id"] = str(msg_id)
     lotteries[str(msg_id)] = lottery_obj
-    await save_data()
+    await db_write(_db_insert_lottery, _lottery_row(lottery_obj))
     # start timer
-    bot.loop.create_task(lottery_timer_task(ctx.guild, str(msg_id), seconds))
-    await ctx.send(f"✅ Lottery created and posted in <#{(await find_or_create_channel(ctx.guild, LOTTERY_DISPLAY_CHANNEL, LOTTERY_CATEGORY_NAME)).id}>. Ticket channel: {ticket_chan.mention}")
+    schedule_lottery(ctx.guild, str(msg_id), seconds)
+    await ctx.send(f"✅ Lottery created and posted in <#{display_channel_id}>. Ticket channel: {ticket_chan.mention}")
 
 @bot.command(name="buy")
 async def buy_tickets(ctx: commands.Context, count: int):
@@ -339,40 +653,34 @@ async def buy_tickets(ctx: commands.Context, count: int):
     if channel.id != display_chan.id:
         return await ctx.send(f"⚠ Use this command in the lottery display channel: {display_chan.mention}")
 
-    # find the latest lottery posted message in this display channel among active lotteries
-    # We'll fetch last 50 messages and find the first one whose id is in lotteries
-    found_msg = None
-    try:
-        async for message in channel.history(limit=50):
-            if str(message.id) in lotteries:
-                found_msg = message
-                break
-    except Exception:
-        pass
-
-    if not found_msg:
+    # the latest lottery posted in this display channel among active lotteries
+    active = active_by_channel.get(display_chan.id)
+    msg_id_str = active[-1] if active else None
+    if not msg_id_str:
         return await ctx.send("⚠ No active lottery found in this channel to buy tickets for.")
 
-    lottery = lotteries.get(str(found_msg.id))
-    if not lottery:
-        return await ctx.send("⚠ Lottery not found or already ended.")
-
-    # check max_tickets constraint
-    current_sold = len(lottery.get("tickets", []))
-    max_tickets = lottery.get("max_tickets")
-    if max_tickets is not None and (current_sold + count) > max_tickets:
-        return await ctx.send(f"⚠ Not enough tickets remaining. Tickets left: {max_tickets - current_sold}")
-
-    # generate ticket codes and append tickets
-    new_codes = []
-    for _ in range(count):
-        code = gen_ticket_code()
-        lottery["tickets"].append({"code": code, "buyer_id": str(ctx.author.id)})
-        new_codes.append(code)
-
-    await save_data()
-    # update display message embed to show new tickets sold count
-    await update_display_message(ctx.guild, int(found_msg.id))
+    # serialize buys per lottery so two purchases can't both pass the max_tickets check
+    async with lottery_locks.setdefault(msg_id_str, asyncio.Lock()):
+        lottery = lotteries.get(msg_id_str)
+        if not lottery:
+            return await ctx.send("⚠ Lottery not found or already ended.")
+
+        # check max_tickets constraint
+        current_sold = len(lottery["codes"])
+        max_tickets = lottery.get("max_tickets")
+        if max_tickets is not None and (current_sold + count) > max_tickets:
+            return await ctx.send(f"⚠ Not enough tickets remaining. Tickets left: {max_tickets - current_sold}")
+
+        # generate ticket codes and append tickets
+        buyer_id = str(ctx.author.id)
+        new_codes = gen_ticket_codes(count)
+        lottery["codes"].extend(new_codes)
+        lottery["buyers"].extend([buyer_id] * count)
+        buyer_index[buyer_id].extend((msg_id_str, c) for c in new_codes)
+
+        await db_write(_db_insert_tickets, [(msg_id_str, c, buyer_id) for c in new_codes])
+        # display embed picks up the new tickets sold count on the next flush
+        _dirty[msg_id_str] = ctx.guild.id
 
     # send DM to buyer with ticket codes
     codes_text = "\n".join(f"- `{c}`" for c in new_codes)
@@ -389,11 +697,11 @@ async def buy_tickets(ctx: commands.Context, count: int):
 async def my_tickets(ctx: commands.Context):
     """List ticket codes the user has across active lotteries (DM)."""
     user_id = str(ctx.author.id)
-    found = []
-    for lid, lot in lotteries.items():
-        user_codes = [t["code"] for t in lot.get("tickets", []) if t["buyer_id"] == user_id]
-        if user_codes:
-            found.append((lot["item"], user_codes))
+    by_lottery: Dict[str, List[str]] = {}
+    for lid, code in buyer_index.get(user_id, []):
+        if lid in lotteries:
+            by_lottery.setdefault(lid, []).append(code)
+    found = [(lotteries[lid]["item"], codes) for lid, codes in by_lottery.items()]
     if not found:
         return await ctx.send("You have no tickets in active lotteries.")
 
@@ -426,14 +734,28 @@ async def lottery_status(ctx: commands.Context):
         return await ctx.send("No active lotteries right now.")
     lines = []
     for lid, lot in lotteries.items():
-        end_ts = int(datetime.datetime.fromisoformat(lot["end_time"]).timestamp())
-        lines.append(f"- **{lot['item']}** | Seller: <@{lot['seller_id']}> | Tickets: {len(lot.get('tickets',[]))} | Ends: <t:{end_ts}:R> | MsgID: {lid}")
+        lines.append(f"- **{lot['item']}** | Seller: <@{lot['seller_id']}> | Tickets: {len(lot['codes'])} | Ends: <t:{lot['end_ts']}:R> | MsgID: {lid}")
     await ctx.send("📋 Active Lotteries:\n" + "\n".join(lines))
 
-# Periodic save to disk
-@tasks.loop(minutes=1)
-async def periodic_save():
-    await save_data()
+# Flush coalesced display updates
+@tasks.loop(seconds=2)
+async def flush_display_updates():
+    if not _dirty:
+        return
+    batch = list(_dirty.items())
+    _dirty.clear()
+    for msg_id_str, guild_id in batch:
+        guild = bot.get_guild(guild_id)
+        if not guild:
+            continue
+        try:
+            await update_display_message(guild, int(msg_id_str))
+        except discord.HTTPException as e:
+            # rate limit or server error: retry on the next tick; other 4xx won't fix themselves
+            if e.status == 429 or e.status >= 500:
+                _dirty.setdefault(msg_id_str, guild_id)
+        except Exception:
+            pass
 
 # Run
 if __name__ == "__main__":